@@ -39,6 +39,13 @@ DB_PORT = os.environ['DB_PORT']
 
 GOOGLE_API_KEY = os.environ['GOOGLE_API_KEY']
 
+# Seconds to keep Google Directions / Distance Matrix responses cached
+GOOGLE_MAPS_CACHE_TIMEOUT = int(os.getenv('GOOGLE_MAPS_CACHE_TIMEOUT', 3600))
+
+# Maximum age in seconds of each process's in-memory station snapshot. Station changes are
+# also broadcast through the cache, but only reach other processes with a shared CACHES backend
+STATION_INDEX_TIMEOUT = int(os.getenv('STATION_INDEX_TIMEOUT', 300))
+
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 # Application definition
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class RoutingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'routing'
+
+    def ready(self):
+        # Connect the signal handlers that keep the station index fresh
+        from . import station_index  # noqa: F401
@@ -1,36 +1,79 @@
-import os, csv, time
-import googlemaps
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os, csv, asyncio
+import aiohttp
+from aiolimiter import AsyncLimiter
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.conf import settings
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from routing.models import FuelStation
+from routing.station_index import StationIndex
 
-# Initialize Google Maps client
-gmaps = googlemaps.Client(key=settings.GOOGLE_API_KEY)
-
-def fetch_coordinates_google(address, retries=3, delay=2):
-    """Fetch latitude and longitude for a given address using Google Maps API with retries."""
-    attempt = 0
-    while attempt < retries:
-        try:
-            result = gmaps.geocode(address)
-            if result:
-                location = result[0]['geometry']['location']
-                print(f"{address}: {location['lat']}, {location['lng']}")
-                return location['lat'], location['lng']
-            else:
-                print(f"Coordinates not found for {address}. Retrying...")
-        except Exception as e:
-            print(f"Error fetching coordinates for {address}: {e}. Retrying...")
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+# Google's rate limit for Geocoding API
+MAX_QUERIES_PER_SECOND = 50
+
+
+class TransientGeocodeError(Exception):
+    """Raised for Geocoding API failures that are worth retrying."""
+
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((TransientGeocodeError, aiohttp.ClientError, asyncio.TimeoutError)),
+    reraise=True,
+)
+async def geocode(session, semaphore, limiter, address):
+    """Call the Geocoding API under the global QPS limit, backing off exponentially on transient errors."""
+    async with semaphore, limiter:
+        async with session.get(GEOCODE_URL, params={"address": address, "key": settings.GOOGLE_API_KEY}) as response:
+            if response.status >= 500:
+                raise TransientGeocodeError(f"HTTP {response.status}")
+            data = await response.json()
+
+    api_status = data.get("status")
+    if api_status in ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR"):
+        raise TransientGeocodeError(api_status)
+    if api_status == "ZERO_RESULTS":
+        return []
+    if api_status != "OK":
+        raise Exception(data.get("error_message", api_status))
+    return data["results"]
+
+
+async def fetch_coordinates_google(session, semaphore, limiter, address):
+    """Fetch latitude and longitude for a given address using Google Maps API."""
+    try:
+        result = await geocode(session, semaphore, limiter, address)
+    except Exception as e:
+        print(f"Failed to fetch coordinates for {address}: {e}")
+        return None, None
 
-        attempt += 1
-        if attempt < retries:
-            print(f"Retrying... ({attempt}/{retries})")
-            time.sleep(delay)  # wait before retrying
+    if not result:
+        print(f"Coordinates not found for {address}.")
+        return None, None
 
-    print(f"Failed to fetch coordinates for {address} after {retries} attempts.")
-    return None, None
+    location = result[0]['geometry']['location']
+    print(f"{address}: {location['lat']}, {location['lng']}")
+    return location['lat'], location['lng']
+
+
+async def geocode_all(addresses_to_geocode):
+    """Geocode (row, address) pairs concurrently and return (row, latitude, longitude) tuples."""
+    semaphore = asyncio.Semaphore(MAX_QUERIES_PER_SECOND)
+    limiter = AsyncLimiter(MAX_QUERIES_PER_SECOND, 1)
+
+    # Many truckstops share an address, so only geocode each distinct one once
+    unique_addresses = list(dict.fromkeys(address for _, address in addresses_to_geocode))
+
+    async with aiohttp.ClientSession() as session:
+        coordinates = await asyncio.gather(*(
+            fetch_coordinates_google(session, semaphore, limiter, address) for address in unique_addresses
+        ))
+
+    coordinates_by_address = dict(zip(unique_addresses, coordinates))
+    return [(row, *coordinates_by_address[address]) for row, address in addresses_to_geocode]
 
 
 class Command(BaseCommand):
@@ -50,59 +93,71 @@ class Command(BaseCommand):
 
         self.stdout.write(self.style.NOTICE(f"Processing CSV file: {file_path}"))
 
+        # Load existing stations once, keyed by stop ID, instead of querying per CSV row
+        existing_stations = FuelStation.objects.in_bulk(field_name='stop_id')
+
         # Read CSV and process records
         with open(file_path, 'r') as file:
-            reader = csv.DictReader(file)
+            reader = csv.reader(file)
             addresses_to_geocode = []
+            updates = []
+
+            # Resolve column positions once so rows can be indexed by integer
+            header = next(reader)
+            i_stop_id = header.index('OPIS Truckstop ID')
+            i_name = header.index('Truckstop Name')
+            i_address = header.index('Address')
+            i_city = header.index('City')
+            i_state = header.index('State')
+            i_rack_id = header.index('Rack ID')
+            i_price = header.index('Retail Price')
 
             for row in reader:
-                stop_id = row["OPIS Truckstop ID"]
-                price_per_gallon = float(row['Retail Price'])
-                station = FuelStation.objects.filter(stop_id=stop_id).first()
+                stop_id = row[i_stop_id]
+                price_per_gallon = float(row[i_price])
+                station = existing_stations.get(int(stop_id))
 
                 if station:
                     # Update price_per_gallon if the record exists
                     station.price_per_gallon = price_per_gallon
-                    station.save()
+                    updates.append(station)
                     self.stdout.write(self.style.SUCCESS(f"Updated price for: {station.name}, {station.city}, {station.state} (Stop ID: {stop_id})"))
                 else:
                     # Add to the list for geocoding
-                    address = f"{row['Truckstop Name'].strip()}, {row['Address'].strip()}, {row['City'].strip()}, {row['State'].strip()}, USA"
+                    address = f"{row[i_name].strip()}, {row[i_address].strip()}, {row[i_city].strip()}, {row[i_state].strip()}, USA"
                     addresses_to_geocode.append((row, address))
 
-        # Use ThreadPoolExecutor for concurrent geocoding requests
-        max_concurrent_requests = 50  # Google's rate limit for Geocoding API
-        results = []
-
-        with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
-            future_to_data = {
-                executor.submit(fetch_coordinates_google, address): row for row, address in addresses_to_geocode
-            }
+        FuelStation.objects.bulk_update(updates, ['price_per_gallon'], batch_size=1000)
 
-            for future in as_completed(future_to_data):
-                try:
-                    row = future_to_data[future]
-                    latitude, longitude = future.result()
-                    results.append((row, latitude, longitude))
-                except Exception as e:
-                    print(f"Error processing address: {row['Truckstop Name'].strip()}, {row['City'].strip()}, {row['State'].strip()}, Error: {e}")
+        # Geocode new addresses concurrently on an asyncio event loop
+        results = asyncio.run(geocode_all(addresses_to_geocode))
 
-        # Save new entries to the database
+        # Save new entries to the database, keyed by stop ID so a station listed twice in the CSV is added once
+        new_stations = {}
         for row, latitude, longitude in results:
+            stop_id = int(row[i_stop_id])
             if latitude and longitude:
-                FuelStation.objects.create(
-                    stop_id=row["OPIS Truckstop ID"],
-                    name=row['Truckstop Name'],
-                    address=row['Address'],
-                    city=row["City"],
-                    state=row["State"],
-                    rack_id=int(row["Rack ID"]),
+                if stop_id in new_stations:
+                    self.stdout.write(self.style.WARNING(f"Skipping: {row[i_name].strip()}, {row[i_city].strip()}, {row[i_state].strip()} , Stop ID {stop_id} already added."))
+                    continue
+                new_stations[stop_id] = FuelStation(
+                    stop_id=stop_id,
+                    name=row[i_name],
+                    address=row[i_address],
+                    city=row[i_city],
+                    state=row[i_state],
+                    rack_id=int(row[i_rack_id]),
                     latitude=latitude,
                     longitude=longitude,
-                    price_per_gallon=float(row['Retail Price'])
+                    price_per_gallon=float(row[i_price])
                 )
-                self.stdout.write(self.style.SUCCESS(f"Added: {row['Truckstop Name'].strip()}, {row['City'].strip()}, {row['State'].strip()} at {latitude}, {longitude}"))
+                self.stdout.write(self.style.SUCCESS(f"Added: {row[i_name].strip()}, {row[i_city].strip()}, {row[i_state].strip()} at {latitude}, {longitude}"))
             else:
-                self.stdout.write(self.style.WARNING(f"Skipping: {row['Truckstop Name'].strip()}, {row['City'].strip()}, {row['State'].strip()} , coordinates not found."))
+                self.stdout.write(self.style.WARNING(f"Skipping: {row[i_name].strip()}, {row[i_city].strip()}, {row[i_state].strip()} , coordinates not found."))
+
+        FuelStation.objects.bulk_create(new_stations.values(), batch_size=1000, ignore_conflicts=True)
+
+        # Bulk writes send no model signals, so tell the web processes to reload stations once committed
+        transaction.on_commit(StationIndex.bump_version)
 
         self.stdout.write(self.style.SUCCESS("Geocoding and updates completed successfully."))
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.4 on 2026-10-15 20:39
+
+from django.db import migrations, models
+
+
+def remove_duplicate_stop_ids(apps, schema_editor):
+    # Earlier imports could store a stop ID more than once; keep the oldest row, which lookups by stop ID returned
+    FuelStation = apps.get_model('routing', 'FuelStation')
+    stations = FuelStation.objects.using(schema_editor.connection.alias)
+    first_pks = stations.values('stop_id').annotate(first_pk=models.Min('pk')).values('first_pk')
+    stations.exclude(pk__in=first_pks).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routing', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_stop_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='fuelstation',
+            name='stop_id',
+            field=models.IntegerField(unique=True),
+        ),
+    ]
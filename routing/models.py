@@ -1,7 +1,7 @@
 from django.db import models
 
 class FuelStation(models.Model):
-    stop_id = models.IntegerField()
+    stop_id = models.IntegerField(unique=True)
     name = models.CharField(max_length=255)
     address = models.TextField()
     city = models.CharField(max_length=255)
@@ -0,0 +1,93 @@
+import hashlib
+import threading
+import time
+import uuid
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from scipy.spatial import cKDTree
+from .models import FuelStation
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StationIndex:
+    """In-memory snapshot of the FuelStation table as column arrays plus a prebuilt cKDTree.
+
+    Stations change rarely, so the snapshot is built once per process and reused across
+    requests. Writers call bump_version(), which stores a new version token in the shared
+    cache; every process rebuilds its snapshot on the next access once the token changes.
+    Snapshots are also rebuilt after STATION_INDEX_TIMEOUT seconds, which bounds staleness
+    when the cache backend is not shared between processes.
+    """
+
+    VERSION_CACHE_KEY = "station-index-version"
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, version=None):
+        self.version = version
+        self.built_at = time.monotonic()
+
+        queryset = FuelStation.objects.order_by("pk").values(
+            "stop_id", "name", "address", "city", "state", "rack_id", "latitude", "longitude", "price_per_gallon"
+        )
+
+        # Identifies this snapshot's contents so derived results can be cached across processes
+        digest = hashlib.md5()
+        # Rows are kept in the API response shape and handed out as-is, so callers must not mutate them
+        self.stations = []
+        for station in queryset.iterator(chunk_size=2000):
+            station = {"id": station.pop("stop_id"), **station}
+            self.stations.append(station)
+            digest.update(repr(station).encode())
+        self.fingerprint = digest.hexdigest()
+
+        count = len(self.stations)
+        self.latitude = np.fromiter((s["latitude"] for s in self.stations), dtype=np.float64, count=count)
+        self.longitude = np.fromiter((s["longitude"] for s in self.stations), dtype=np.float64, count=count)
+        self.price_per_gallon = np.fromiter((s["price_per_gallon"] for s in self.stations), dtype=np.float64, count=count)
+
+        self.tree = None
+        if self.stations:
+            self.tree = cKDTree(np.column_stack((self.latitude, self.longitude)), leafsize=32, balanced_tree=True, compact_nodes=True)
+        logger.info(f"Built station index with {len(self)} stations.")
+
+    def __len__(self):
+        return len(self.stations)
+
+    @classmethod
+    def instance(cls):
+        version = cache.get(cls.VERSION_CACHE_KEY)
+        with cls._lock:
+            current = cls._instance
+            if (
+                current is None
+                or current.version != version
+                or time.monotonic() - current.built_at > settings.STATION_INDEX_TIMEOUT
+            ):
+                cls._instance = cls(version)
+            return cls._instance
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._instance = None
+
+    @classmethod
+    def bump_version(cls):
+        # Tell every process sharing the cache that the station table changed
+        cache.set(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        cls.invalidate()
+
+
+@receiver(post_save, sender=FuelStation)
+@receiver(post_delete, sender=FuelStation)
+def invalidate_station_index(sender, **kwargs):
+    # Publish the new version only once the change is visible to other processes
+    transaction.on_commit(StationIndex.bump_version)
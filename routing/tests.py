@@ -1,3 +1,511 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIRequestFactory
+from scipy.spatial import cKDTree
+from tenacity import wait_none
+
+from .management.commands.geocode_addresses import TransientGeocodeError, geocode, geocode_all
+from .models import FuelStation
+from .station_index import StationIndex
+from .views import (
+    DISTANCE_MATRIX_LEGS_PER_REQUEST,
+    EARTH_RADIUS_MILES,
+    OptimalFuelRouteView,
+    cumulative_route_miles,
+    find_actual_distances,
+    find_optimal_stations,
+    find_polyline_points,
+    find_stations_near_route,
+    parse_location,
+)
+
+
+def create_station(stop_id, latitude=35.0, longitude=-100.0, price=3.5):
+    return FuelStation.objects.create(
+        stop_id=stop_id, name=f"Station {stop_id}", address="1 Main St", city="Town", state="TX",
+        rack_id=1, latitude=latitude, longitude=longitude, price_per_gallon=price,
+    )
+
+
+class StationIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        StationIndex.invalidate()
+
+    def test_builds_arrays_and_tree_from_the_table(self):
+        create_station(2, 36.0, -101.0, 3.2)
+        create_station(1, 35.0, -100.0, 3.1)
+
+        station_index = StationIndex.instance()
+
+        self.assertEqual(len(station_index), 2)
+        self.assertEqual([s["id"] for s in station_index.stations], [2, 1])
+        self.assertEqual(list(station_index.latitude), [36.0, 35.0])
+        self.assertEqual(list(station_index.longitude), [-101.0, -100.0])
+        self.assertEqual(list(station_index.price_per_gallon), [3.2, 3.1])
+        self.assertEqual(station_index.tree.n, 2)
+
+    def test_empty_table(self):
+        station_index = StationIndex.instance()
+
+        self.assertEqual(len(station_index), 0)
+        self.assertIsNone(station_index.tree)
+
+    def test_reuses_instance_while_version_is_unchanged(self):
+        create_station(1)
+
+        self.assertIs(StationIndex.instance(), StationIndex.instance())
+
+    def test_rebuilds_when_another_process_bumps_the_version(self):
+        create_station(1)
+        station_index = StationIndex.instance()
+
+        # Simulate a bump published by another process sharing the cache
+        cache.set(StationIndex.VERSION_CACHE_KEY, "other-process", None)
+
+        self.assertIsNot(StationIndex.instance(), station_index)
+        self.assertEqual(StationIndex.instance().version, "other-process")
+
+    def test_rebuilds_after_timeout(self):
+        create_station(1)
+        with mock.patch("routing.station_index.time.monotonic", return_value=1000.0):
+            station_index = StationIndex.instance()
+
+        with self.settings(STATION_INDEX_TIMEOUT=300):
+            with mock.patch("routing.station_index.time.monotonic", return_value=1200.0):
+                self.assertIs(StationIndex.instance(), station_index)
+            with mock.patch("routing.station_index.time.monotonic", return_value=1301.0):
+                self.assertIsNot(StationIndex.instance(), station_index)
+
+    def test_saves_bump_the_version_on_commit(self):
+        station_index = StationIndex.instance()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                create_station(1)
+                # Not yet committed, so other processes must keep the old version
+                self.assertIsNone(cache.get(StationIndex.VERSION_CACHE_KEY))
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertIsNotNone(cache.get(StationIndex.VERSION_CACHE_KEY))
+        self.assertIsNot(StationIndex.instance(), station_index)
+        self.assertEqual(len(StationIndex.instance()), 1)
+
+    def test_deletes_bump_the_version_on_commit(self):
+        station = create_station(1)
+        self.assertEqual(len(StationIndex.instance()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            station.delete()
+
+        self.assertEqual(len(StationIndex.instance()), 0)
+
+
+def distance_matrix_response(params):
+    # Distance from origin i to destination i is (i + 1) miles within each request
+    origins = params["origins"].split("|")
+    response = mock.Mock()
+    response.json.return_value = {
+        "status": "OK",
+        "rows": [
+            {"elements": [{"status": "OK", "distance": {"value": (i + 1) * 1609.34}} for _ in origins]}
+            for i in range(len(origins))
+        ],
+    }
+    return response
+
+
+class GoogleMapsCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_reuses_cached_directions(self):
+        directions = [{
+            "legs": [{"distance": {"value": 160934}}],
+            "overview_polyline": {"points": "_p~iF~ps|U_ulLnnqC_mqNvxq`@"},
+        }]
+
+        with mock.patch("routing.views.gmaps.directions", return_value=directions) as get_directions:
+            find_polyline_points((38.5, -120.2), (43.252, -126.453))
+            decoded_path, total_distance = find_polyline_points((38.5, -120.2), (43.252, -126.453))
+
+        self.assertEqual(get_directions.call_count, 1)
+        np.testing.assert_allclose(decoded_path, [[40.7, -120.95], [43.252, -126.453]])
+        self.assertAlmostEqual(total_distance, 100.0)
+
+    def test_reuses_cached_distances(self):
+        locations = ["30,-90", "31,-90", "32,-90"]
+
+        with mock.patch("routing.views.session.get") as get:
+            get.side_effect = lambda url, params: distance_matrix_response(params)
+            find_actual_distances(locations)
+            distances = find_actual_distances(locations)
+
+        self.assertEqual(get.call_count, 1)
+        np.testing.assert_allclose(distances, [1, 2])
+
+
+CSV_HEADER = "OPIS Truckstop ID,Truckstop Name,Address,City,State,Rack ID,Retail Price\n"
+
+
+class GeocodeAddressesCommandTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def run_command(self, csv_rows, coordinates):
+        # coordinates maps an address to the (lat, lng) the mocked Geocoding API returns for it
+        async def geocode(session, semaphore, limiter, address):
+            if address not in coordinates:
+                return []
+            latitude, longitude = coordinates[address]
+            return [{"geometry": {"location": {"lat": latitude, "lng": longitude}}}]
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as csv_file:
+            csv_file.write(CSV_HEADER + "".join(csv_rows))
+        self.addCleanup(os.remove, csv_file.name)
+
+        stdout = StringIO()
+        with mock.patch("routing.management.commands.geocode_addresses.geocode", side_effect=geocode) as geocode_mock:
+            with mock.patch("builtins.print"), self.captureOnCommitCallbacks(execute=True):
+                call_command("geocode_addresses", csv_file.name, stdout=stdout)
+        return stdout.getvalue(), geocode_mock
+
+    def test_updates_prices_and_adds_new_stations(self):
+        create_station(1, price=3.0)
+
+        output, _ = self.run_command(
+            ["1,Station 1,1 Main St,Town,TX,1,3.25\n", "2,Stop Two,2 Oak Rd,Ville,OK,7,3.5\n"],
+            {"Stop Two, 2 Oak Rd, Ville, OK, USA": (36.0, -97.0)},
+        )
+
+        self.assertEqual(FuelStation.objects.get(stop_id=1).price_per_gallon, 3.25)
+        added = FuelStation.objects.get(stop_id=2)
+        self.assertEqual((added.name, added.rack_id, added.latitude, added.longitude), ("Stop Two", 7, 36.0, -97.0))
+        self.assertIn("Updated price for: Station 1", output)
+        self.assertIn("Added: Stop Two", output)
+
+    def test_skips_stations_without_coordinates(self):
+        output, _ = self.run_command(["2,Stop Two,2 Oak Rd,Ville,OK,7,3.5\n"], {})
+
+        self.assertFalse(FuelStation.objects.exists())
+        self.assertIn("coordinates not found", output)
+
+    def test_adds_a_repeated_stop_id_once_from_its_first_row(self):
+        output, _ = self.run_command(
+            ["3,Stop Three,3 Elm St,Ville,OK,7,3.5\n", "3,Stop Three,3 Elm Street,Ville,OK,7,3.6\n"],
+            {"Stop Three, 3 Elm St, Ville, OK, USA": (36.0, -97.0), "Stop Three, 3 Elm Street, Ville, OK, USA": (36.1, -97.1)},
+        )
+
+        self.assertEqual(FuelStation.objects.count(), 1)
+        self.assertEqual(FuelStation.objects.get(stop_id=3).price_per_gallon, 3.5)
+        self.assertEqual(output.count("Added: Stop Three"), 1)
+        self.assertIn("Stop ID 3 already added", output)
+
+    def test_bumps_station_index_version(self):
+        self.run_command(["2,Stop Two,2 Oak Rd,Ville,OK,7,3.5\n"], {"Stop Two, 2 Oak Rd, Ville, OK, USA": (36.0, -97.0)})
+
+        self.assertIsNotNone(cache.get(StationIndex.VERSION_CACHE_KEY))
+
+
+class FakeGeocodeResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def json(self):
+        return self.data
+
+
+class GeocodeRetryTests(SimpleTestCase):
+    def geocode(self, *responses):
+        # Return the given (HTTP status, JSON body) pairs one per attempt, without waiting between attempts
+        session = mock.Mock()
+        session.get.side_effect = [FakeGeocodeResponse(*response) for response in responses]
+        result = asyncio.run(geocode.retry_with(wait=wait_none())(
+            session, asyncio.Semaphore(1), mock.MagicMock(), "1 Main St, Town, TX, USA"
+        ))
+        return result, session.get.call_count
+
+    def test_retries_transient_errors(self):
+        result, attempts = self.geocode(
+            (503, {}),
+            (200, {"status": "OVER_QUERY_LIMIT"}),
+            (200, {"status": "OK", "results": [{"geometry": {"location": {"lat": 35.0, "lng": -100.0}}}]}),
+        )
+
+        self.assertEqual(attempts, 3)
+        self.assertEqual(result[0]["geometry"]["location"], {"lat": 35.0, "lng": -100.0})
+
+    def test_gives_up_after_five_attempts(self):
+        with self.assertRaises(TransientGeocodeError):
+            self.geocode(*[(200, {"status": "UNKNOWN_ERROR"})] * 5)
+
+    def test_does_not_retry_permanent_errors(self):
+        with self.assertRaisesMessage(Exception, "bad key"):
+            self.geocode((200, {"status": "REQUEST_DENIED", "error_message": "bad key"}))
+
+    def test_zero_results(self):
+        self.assertEqual(self.geocode((200, {"status": "ZERO_RESULTS"})), ([], 1))
+
+
+class GeocodeAllTests(SimpleTestCase):
+    def test_geocodes_each_distinct_address_once(self):
+        async def geocode(session, semaphore, limiter, address):
+            return [{"geometry": {"location": {"lat": len(address), "lng": -100.0}}}]
+
+        addresses_to_geocode = [("row 1", "A St"), ("row 2", "Bee St"), ("row 3", "A St")]
+        with mock.patch("routing.management.commands.geocode_addresses.geocode", side_effect=geocode) as geocode_mock:
+            with mock.patch("builtins.print"):
+                results = asyncio.run(geocode_all(addresses_to_geocode))
+
+        self.assertEqual(sorted(call.args[3] for call in geocode_mock.call_args_list), ["A St", "Bee St"])
+        self.assertEqual(results, [("row 1", 4, -100.0), ("row 2", 6, -100.0), ("row 3", 4, -100.0)])
+
+
+class OptimalFuelRouteViewTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def post(self, **data):
+        data = {"start_location": "(34.05, -118.24)", "finish_location": "(34.5, -118.0)", **data}
+        # A 100-mile route is within range, so the view answers without planning stops
+        station_index = mock.MagicMock(price_per_gallon=np.array([3.0, 4.0]))
+        station_index.__len__.return_value = 2
+        with mock.patch("routing.views.find_polyline_points", return_value=(np.empty((0, 2)), 100.0)), \
+                mock.patch("routing.views.StationIndex.instance", return_value=station_index):
+            request = APIRequestFactory().post("/api/get-route/", data, format="json")
+            return OptimalFuelRouteView.as_view()(request)
+
+    def test_missing_location(self):
+        response = self.post(finish_location="")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["error"], "start_location and finish_location are required fields.")
+
+    def test_malformed_location(self):
+        for value in ("(34.05)", "somewhere", 34.05, "nan, nan", "(200, 500)"):
+            with self.subTest(value=value):
+                response = self.post(start_location=value)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("must be formatted", response.data["error"])
+
+    def test_short_route_is_priced_at_the_average(self):
+        response = self.post()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["optimal_route"], [])
+        self.assertAlmostEqual(response.data["total_cost"], 35.0)
+
+    def test_buffer_range_is_ignored_with_a_warning(self):
+        with self.assertLogs("routing.views", "WARNING") as logs:
+            response = self.post(buffer_range=50)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("buffer_range is deprecated", logs.output[0])
+
+    def test_stop_penalty_accepts_non_negative_numbers(self):
+        for stop_penalty in (0, 12.5, "25"):
+            with self.subTest(stop_penalty=stop_penalty):
+                self.assertEqual(self.post(stop_penalty=stop_penalty).status_code, 200)
+
+    def test_stop_penalty_rejects_invalid_values(self):
+        for stop_penalty in (-1, "abc", None, [25], "nan", "inf"):
+            with self.subTest(stop_penalty=stop_penalty):
+                response = self.post(stop_penalty=stop_penalty)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.data["error"], "stop_penalty must be a non-negative number.")
+
+
+def make_station(stop_id, price):
+    return {"id": stop_id, "name": f"Station {stop_id}", "price_per_gallon": price}
+
+
+class FindOptimalStationsTests(SimpleTestCase):
+    def test_reaches_finish_through_cheapest_stations(self):
+        # Two candidates for each stop; the cheaper one in each pair should be chosen
+        stations = [make_station(1, 4.0), make_station(2, 3.0), make_station(3, 4.5), make_station(4, 3.5)]
+        route_miles = np.array([400.0, 410.0, 800.0, 810.0])
+
+        optimal_stations = find_optimal_stations(stations, route_miles, 1200, 500, 10, 4.0)
+
+        self.assertEqual([s["id"] for s in optimal_stations], [2, 4])
+
+    def test_buys_more_fuel_early_when_it_is_cheaper(self):
+        # Stopping at the cheap first station and driving past the dearer second one beats stopping at both
+        stations = [make_station(1, 3.0), make_station(2, 4.0), make_station(3, 3.5)]
+        route_miles = np.array([200.0, 400.0, 650.0])
+
+        optimal_stations = find_optimal_stations(stations, route_miles, 1000, 500, 10, 4.0)
+
+        self.assertEqual([s["id"] for s in optimal_stations], [1, 3])
+
+    def test_routes_to_furthest_station_when_finish_is_unreachable(self):
+        stations = [make_station(1, 3.0), make_station(2, 3.0), make_station(3, 3.0)]
+        route_miles = np.array([300.0, 700.0, 1300.0])
+
+        optimal_stations = find_optimal_stations(stations, route_miles, 1800, 500, 10, 4.0)
+
+        self.assertEqual([s["id"] for s in optimal_stations], [1, 2])
+
+    def test_prefers_fewer_stops_at_equal_cost(self):
+        stations = [make_station(1, 3.0), make_station(2, 3.0)]
+        route_miles = np.array([300.0, 450.0])
+
+        optimal_stations = find_optimal_stations(stations, route_miles, 850, 500, 10, 3.0)
+
+        self.assertEqual([s["id"] for s in optimal_stations], [2])
+
+    def test_stop_penalty_avoids_stops_that_save_little(self):
+        # Stopping at the first station saves $1.50 of fuel over driving straight to the second
+        stations = [make_station(1, 3.0), make_station(2, 2.9)]
+        route_miles = np.array([300.0, 450.0])
+
+        optimal_stations = find_optimal_stations(stations, route_miles, 800, 500, 10, 3.1)
+        self.assertEqual([s["id"] for s in optimal_stations], [1, 2])
+
+        optimal_stations = find_optimal_stations(stations, route_miles, 800, 500, 10, 3.1, stop_penalty=25)
+        self.assertEqual([s["id"] for s in optimal_stations], [2])
+
+    def test_no_nearby_stations(self):
+        self.assertEqual(find_optimal_stations([], np.empty(0), 1200, 500, 10, 4.0), [])
+
+
+class FindActualDistancesTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_batches_legs_across_requests(self):
+        locations = [f"{30 + i},-90" for i in range(DISTANCE_MATRIX_LEGS_PER_REQUEST + 4)]
+
+        with mock.patch("routing.views.session.get") as get:
+            get.side_effect = lambda url, params: distance_matrix_response(params)
+            distances = find_actual_distances(locations)
+
+        self.assertEqual(get.call_count, 2)
+        first, second = (call.kwargs["params"] for call in get.call_args_list)
+        self.assertEqual(first["origins"].split("|"), locations[:10])
+        self.assertEqual(first["destinations"].split("|"), locations[1:11])
+        self.assertEqual(second["origins"].split("|"), locations[10:-1])
+        self.assertEqual(second["destinations"].split("|"), locations[11:])
+        np.testing.assert_allclose(distances, list(range(1, 11)) + [1, 2, 3])
+
+    def test_failed_element_counts_as_zero(self):
+        with mock.patch("routing.views.session.get") as get:
+            get.return_value.json.return_value = {"status": "OK", "rows": [{"elements": [{"status": "NOT_FOUND"}]}]}
+            self.assertEqual(find_actual_distances(["30,-90", "31,-90"]), [0])
+
+    def test_raises_on_failed_request(self):
+        with mock.patch("routing.views.session.get") as get:
+            get.return_value.json.return_value = {"status": "MAX_ELEMENTS_EXCEEDED"}
+            with self.assertRaisesMessage(Exception, "MAX_ELEMENTS_EXCEEDED"):
+                find_actual_distances(["30,-90", "31,-90"])
+
+
+class CumulativeRouteMilesTests(SimpleTestCase):
+    def test_scales_arc_length_to_road_distance(self):
+        # A degree of longitude at 60N is half a degree of latitude, so the first segment is a third of the route
+        decoded_path = np.array([[60.0, -100.0], [60.0, -99.0], [61.0, -99.0]])
+
+        route_miles = cumulative_route_miles(decoded_path, 300.0)
+
+        np.testing.assert_allclose(route_miles, [0.0, 100.0, 300.0], rtol=1e-3)
+
+    def test_stationary_path(self):
+        decoded_path = np.array([[35.0, -100.0], [35.0, -100.0]])
+
+        np.testing.assert_array_equal(cumulative_route_miles(decoded_path, 0.0), [0.0, 0.0])
+
+
+class ParseLocationTests(SimpleTestCase):
+    def test_parses_parenthesized_pair(self):
+        self.assertEqual(parse_location("(34.052235, -118.243683)"), (34.052235, -118.243683))
+
+    def test_parses_bare_pair(self):
+        self.assertEqual(parse_location("34.05,-118.24"), (34.05, -118.24))
+
+    def test_accepts_the_edges_of_the_globe(self):
+        self.assertEqual(parse_location("(-90, 180)"), (-90.0, 180.0))
+
+    def test_rejects_malformed_input(self):
+        for value in ("", "(34.05)", "(34.05, -118.24, 10)", "(north, west)"):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_location(value)
+
+    def test_rejects_non_finite_and_out_of_range_coordinates(self):
+        for value in ("nan, nan", "inf, 0", "(0, -inf)", "(200, 500)", "(90.5, 0)", "(0, -180.5)"):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_location(value)
+
+
+def make_station_index(coordinates):
+    # Only the attributes find_stations_near_route reads
+    coordinates = np.array(coordinates, dtype=np.float64)
+    return SimpleNamespace(
+        tree=cKDTree(coordinates),
+        latitude=coordinates[:, 0],
+        longitude=coordinates[:, 1],
+        stations=[{"id": i} for i in range(len(coordinates))],
+    )
+
+
+def east_of(latitude, longitude, miles):
+    # The point the given number of miles due east (west if negative) of (latitude, longitude)
+    return latitude, longitude + np.degrees(miles / (EARTH_RADIUS_MILES * np.cos(np.radians(latitude))))
+
+
+class FindStationsNearRouteTests(SimpleTestCase):
+    def north_route(self, longitude, first_latitude, last_latitude):
+        # A due-north route with a point every ~0.35 miles
+        latitudes = np.arange(first_latitude, last_latitude + 1e-9, 0.005)
+        return np.column_stack((latitudes, np.full(len(latitudes), longitude)))
+
+    def test_deviation_limit_at_high_latitude(self):
+        decoded_path = self.north_route(-147.0, 60.0, 66.0)
+        station_index = make_station_index([east_of(64.0, -147.0, 1.95), east_of(64.0, -147.0, 2.05)])
+
+        nearby_stations_list, _ = find_stations_near_route(decoded_path, station_index, 2)
+
+        self.assertEqual([s["id"] for s in nearby_stations_list], [0])
+
+    def test_stations_east_and_west_of_a_long_north_south_route(self):
+        # Across 25N to 48N one projection at the mean latitude is off by up to 20% east-west
+        decoded_path = self.north_route(-95.0, 25.0, 48.0)
+        station_index = make_station_index([
+            east_of(26.0, -95.0, 2.2),   # would look 1.96 miles away at the mean latitude
+            east_of(47.0, -95.0, -1.9),  # would look 2.23 miles away at the mean latitude
+            east_of(47.0, -95.0, 2.1),
+            east_of(26.0, -95.0, -1.9),
+        ])
+
+        nearby_stations_list, _ = find_stations_near_route(decoded_path, station_index, 2)
+
+        self.assertEqual([s["id"] for s in nearby_stations_list], [3, 1])
+
+    def test_orders_stations_by_route_progress(self):
+        decoded_path = self.north_route(-95.0, 30.0, 31.0)
+        station_index = make_station_index([
+            east_of(30.8, -95.0, 1.0), east_of(30.2, -95.0, -0.5), east_of(30.5, -95.0, 0.1), (35.0, -95.0),
+        ])
+
+        nearby_stations_list, path_positions = find_stations_near_route(decoded_path, station_index, 2)
+
+        self.assertEqual([s["id"] for s in nearby_stations_list], [1, 2, 0])
+        np.testing.assert_allclose(decoded_path[path_positions, 0], [30.2, 30.5, 30.8])
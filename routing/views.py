@@ -1,86 +1,151 @@
-import ast
+import hashlib
+import itertools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from geopy.distance import geodesic
 import googlemaps
-from .models import FuelStation
+from pypolyline.cutil import decode_polyline
+from .station_index import StationIndex
 from django.conf import settings
+from django.core.cache import cache
 from scipy.spatial import cKDTree
 import numpy as np
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shared HTTP sessions so Google API calls reuse pooled keep-alive connections
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# The googlemaps client retries 5xx and OVER_QUERY_LIMIT itself, so its session must not retry as well
+gmaps_session = requests.Session()
+gmaps_session.mount("https://", HTTPAdapter(pool_maxsize=64))
+
 # Google Maps API Key
 api_key = settings.GOOGLE_API_KEY
-gmaps = googlemaps.Client(key=api_key)
+gmaps = googlemaps.Client(key=api_key, requests_session=gmaps_session)
+
+# Mean Earth radius in miles
+EARTH_RADIUS_MILES = 3958.8
+
+def project_equirectangular(coords, reference_latitude):
+    # Project (lat, lng) degrees onto a plane in miles scaled at reference_latitude, so short
+    # distances become plain Euclidean ones without the trig of a great-circle formula
+    latlon = np.radians(coords)
+    x = latlon[..., 1] * np.cos(np.radians(reference_latitude)) * EARTH_RADIUS_MILES
+    y = latlon[..., 0] * EARTH_RADIUS_MILES
+    return np.stack((x, y), axis=-1)
+
+def equirectangular_miles(a, b):
+    # Distance in miles between (lat, lng) degree points a and b, measured on an equirectangular projection
+    # at each pair's own mid-latitude; accurate for the short distances it is used on. a and b broadcast
+    a = np.radians(a)
+    b = np.radians(b)
+    dy = b[..., 0] - a[..., 0]
+    dx = (b[..., 1] - a[..., 1]) * np.cos((a[..., 0] + b[..., 0]) / 2)
+    return np.hypot(dx, dy) * EARTH_RADIUS_MILES
+
+def parse_location(value):
+    # Parse a "(lat, lng)" string into a pair of floats; raises ValueError if malformed or off the globe
+    latitude, longitude = map(float, value.strip("() ").split(","))
+    if not (abs(latitude) <= 90 and abs(longitude) <= 180):  # Also false for nan
+        raise ValueError(f"Invalid coordinates: {value}")
+    return latitude, longitude
+
+def round_location(location):
+    # Snap a (lat, lng) pair to a ~100 m grid so nearby requests share cached Google responses
+    return round(float(location[0]), 3), round(float(location[1]), 3)
 
 def find_polyline_points(start_location, finish_location):
-    # Get polyline from Google Directions API
-    logger.info("Fetching directions from Google Maps API...")
-    directions = gmaps.directions(start_location, finish_location, mode="driving")
+    # Get polyline from Google Directions API, reusing a cached response when available
+    cache_key = f"directions:{start_location[0]},{start_location[1]}:{finish_location[0]},{finish_location[1]}:driving"
+    directions = cache.get(cache_key)
+    if directions is None:
+        logger.info("Fetching directions from Google Maps API...")
+        directions = gmaps.directions(start_location, finish_location, mode="driving")
+        if directions:
+            cache.set(cache_key, directions, settings.GOOGLE_MAPS_CACHE_TIMEOUT)
 
     if not directions or 'legs' not in directions[0]:
         return Response({"error": "No valid route found."}, status=status.HTTP_404_NOT_FOUND)
 
     total_distance = directions[0]["legs"][0]["distance"]["value"] / 1609.34  # Convert meters to miles
-    polyline = directions[0]["overview_polyline"]["points"]
-    decoded_path = googlemaps.convert.decode_polyline(polyline)[1:]
+    encoded_polyline = directions[0]["overview_polyline"]["points"]
+    # pypolyline decodes natively and returns (lng, lat) pairs; flip to (lat, lng)
+    decoded_path = np.array(decode_polyline(encoded_polyline.encode(), 5), dtype=np.float64).reshape(-1, 2)[1:, ::-1]
     logger.info(f"Decoded polyline into {len(decoded_path)} points.")
     return decoded_path, total_distance
 
-def find_stations_near_route(start_location, decoded_path, all_stations, station_tree, deviation_limit):
-    # Query stations near each path point
-    nearby_stations = {}
-    path_coords = np.array([(point["lat"], point["lng"]) for point in decoded_path])
-
-    # Convert deviation_limit from miles to degrees (~1 mile ≈ 0.0145 degrees)
-    deviation_limit_degrees = deviation_limit / 69.0
-
-    for path_point in path_coords:
-        # Query stations within the deviation limit
-        indices = station_tree.query_ball_point(path_point, deviation_limit_degrees)
-        for idx in indices:
-            station = all_stations[idx]
-            station_id = station.stop_id
-            if station_id not in nearby_stations:
-                nearby_stations[station_id] = {
-                    "id": station.stop_id,
-                    "name": station.name,
-                    "address": station.address,
-                    "city": station.city,
-                    "state": station.state,
-                    "rack_id": station.rack_id,
-                    "latitude": station.latitude,
-                    "longitude": station.longitude,
-                    "price_per_gallon": station.price_per_gallon,
-                }
-
-    nearby_stations_list = list(nearby_stations.values())
-
-    # Sort nearby stations by distance from start_location
-    nearby_stations_list.sort(key=lambda station: geodesic(start_location, (station["latitude"], station["longitude"])).miles)
+def find_stations_near_route(decoded_path, station_index, deviation_limit):
+    # Query candidate stations near all path points in a single batched tree lookup.
+    # A degree of longitude shrinks towards the poles, so size the ball for the route's poleward-most point
+    max_latitude = min(np.abs(decoded_path[:, 0]).max(), 89.0)
+    deviation_limit_degrees = deviation_limit / (69.0 * np.cos(np.radians(max_latitude)))
+
+    idx_lists = station_index.tree.query_ball_point(decoded_path, deviation_limit_degrees, workers=-1, return_sorted=False)
+    unique_idx = np.unique(np.fromiter(itertools.chain.from_iterable(idx_lists), dtype=np.int64))
+
+    # Order candidates by progress along the route, i.e. the index of the closest path point, and keep those
+    # within deviation_limit of it
+    path_positions = np.empty(0, dtype=np.int64)
+    if len(unique_idx):
+        station_coords = np.column_stack((station_index.latitude[unique_idx], station_index.longitude[unique_idx]))
+
+        # Find nearby path points on one projection for the whole route. Its east-west scale is off by
+        # cos(reference) / cos(latitude) away from the reference latitude, so search with a bound loosened by
+        # that factor and take a few nearest points per station
+        reference_latitude = decoded_path[:, 0].mean()
+        looseness = max(1.0, np.cos(np.radians(reference_latitude)) / np.cos(np.radians(max_latitude)))
+        k = min(4, len(decoded_path))
+        _, nearest = cKDTree(project_equirectangular(decoded_path, reference_latitude)).query(
+            project_equirectangular(station_coords, reference_latitude), k=k,
+            distance_upper_bound=deviation_limit * looseness * 1.01,
+        )
+        nearest = nearest.reshape(len(unique_idx), k)
+
+        # Measure the real deviation to each of those points at the pair's own latitude
+        found = nearest < len(decoded_path)
+        nearest = np.where(found, nearest, 0)
+        deviations = np.where(found, equirectangular_miles(station_coords[:, None, :], decoded_path[nearest]), np.inf)
+        closest = deviations.argmin(axis=1)
+        rows = np.arange(len(unique_idx))
+        within = deviations[rows, closest] <= deviation_limit
+
+        path_positions = nearest[rows, closest][within]
+        order = np.argsort(path_positions, kind="stable")
+        unique_idx, path_positions = unique_idx[within][order], path_positions[order]
+
+    nearby_stations_list = [station_index.stations[idx] for idx in unique_idx]
 
     logger.info(f"Filtered to {len(nearby_stations_list)} stations within {deviation_limit} miles of the route.")
-    return nearby_stations_list
-
-def calculate_fuel_cost(distances, all_stations, optimal_stations, fuel_efficiency):
-    # Calculate fuel costs
+    return nearby_stations_list, path_positions
+
+def cumulative_route_miles(decoded_path, total_distance):
+    # Miles travelled along the route at each path point, scaled so the last point matches the road distance
+    route_miles = np.concatenate(([0.0], np.cumsum(equirectangular_miles(decoded_path[:-1], decoded_path[1:]))))
+    if route_miles[-1] > 0:
+        route_miles *= total_distance / route_miles[-1]
+    return route_miles
+
+def calculate_fuel_cost(distances, average_price, optimal_stations, fuel_efficiency):
+    # Calculate fuel costs with the same pricing rule find_optimal_stations minimizes: each leg's
+    # fuel is bought where it starts, and the first leg at the average price
     fuel_costs = []
 
     for i, distance in enumerate(distances):
-        if i < len(optimal_stations):
-            price_per_gallon = optimal_stations[i]["price_per_gallon"]
-            logger.info(f"Price per gallon for this leg: {price_per_gallon}")
+        if i == 0:
+            price_per_gallon = average_price
+            logger.info(f"Price per gallon for first leg: {price_per_gallon}")
         else:
-            if optimal_stations:
-                price_per_gallon = sum([station['price_per_gallon'] for station in optimal_stations]) / len(
-                    optimal_stations)
-            else:
-                price_per_gallon = sum([station.price_per_gallon for station in all_stations]) / len(all_stations)
-            logger.info(f"Price per gallon for final leg: {price_per_gallon}")
+            price_per_gallon = optimal_stations[i - 1]["price_per_gallon"]
+            logger.info(f"Price per gallon for this leg: {price_per_gallon}")
 
         fuel_cost = (distance / fuel_efficiency) * price_per_gallon
         fuel_costs.append(fuel_cost)
@@ -94,73 +159,108 @@ def calculate_fuel_cost(distances, all_stations, optimal_stations, fuel_efficien
     logger.info(f"Total Fuel Cost (USD): {total_fuel_cost}")
     return total_fuel_cost
 
+# Default cost in USD charged per refuel stop when planning. Zero keeps the plan at the minimum fuel cost;
+# callers can raise it so that small fuel savings don't justify a stop
+STOP_PENALTY_USD = 0
+
+# Legs per Distance Matrix call; a 10 x 10 request stays within Google's 100-element limit
+DISTANCE_MATRIX_LEGS_PER_REQUEST = 10
+
 def find_actual_distances(locations):
 
     url = "https://maps.googleapis.com/maps/api/distancematrix/json"
+    cache_key = "distancematrix:" + hashlib.md5("|".join(locations).encode()).hexdigest()
 
-    # Make a single Distance Matrix API call
-    response = requests.get(url, params={
-        "origins": "|".join(locations[:-1]),
-        "destinations": "|".join(locations[1:]),
-        "key": api_key
-    }).json()
+    distances = cache.get(cache_key)
+    if distances is not None:
+        return distances
 
-    # Extract distances in miles between adjacent locations
+    # Extract distances in miles between adjacent locations, a batch of legs per Distance Matrix API call
     distances = []
-    for i in range(len(locations) - 1):
-        element = response["rows"][i]["elements"][i]
-        if element["status"] == "OK":
-            distances.append(element["distance"]["value"] / 1609.34)  # Convert meters to miles
-        else:
-            distances.append(0)
+    for first in range(0, len(locations) - 1, DISTANCE_MATRIX_LEGS_PER_REQUEST):
+        batch = locations[first:first + DISTANCE_MATRIX_LEGS_PER_REQUEST + 1]
+        response = session.get(url, params={
+            "origins": "|".join(batch[:-1]),
+            "destinations": "|".join(batch[1:]),
+            "key": api_key
+        }).json()
+        if response.get("status") != "OK":
+            raise Exception(f"Distance Matrix request failed: {response.get('status')}")
+
+        for i in range(len(batch) - 1):
+            element = response["rows"][i]["elements"][i]
+            if element["status"] == "OK":
+                distances.append(element["distance"]["value"] / 1609.34)  # Convert meters to miles
+            else:
+                distances.append(0)
+
+    cache.set(cache_key, distances, settings.GOOGLE_MAPS_CACHE_TIMEOUT)
     return distances
 
-def find_optimal_stations(start_location, nearby_stations_list, truck_range, buffer_range, finish_location):
-    # Select optimal stations for refueling
+def find_optimal_stations(nearby_stations_list, route_miles, total_distance, truck_range, fuel_efficiency, average_price,
+                          stop_penalty=STOP_PENALTY_USD):
+    # Select refueling stations minimizing total fuel cost with a shortest-path DP over the stations.
+    # Node 0 is the start, node i + 1 is nearby_stations_list[i] and the finish is handled separately.
+    # nearby_stations_list is ordered along the route and route_miles holds each station's mileage,
+    # so edges only lead forward, every node is final once the nodes before it are processed and leg
+    # lengths are differences in mileage.
+    # An edge u -> v exists when v is within range of u and costs the fuel for that leg at u's price;
+    # the truck is assumed to leave the start with fuel bought at the average price.
+    # Every stop adds stop_penalty dollars (none by default) so that a detour is only taken when the fuel
+    # it saves outweighs the stop, and equal-cost plans prefer fewer stops.
     optimal_stations = []
-    current_position = start_location
-
-    while True:
-        # Filter stations directly within the buffer range
-        stations_in_buffer = [
-            station for station in nearby_stations_list
-            if (truck_range - buffer_range) <= geodesic(current_position, (station["latitude"], station["longitude"])).miles <= (truck_range - 25)]
-
-        # If no stations are found, adjust buffer range and retry
-        if not stations_in_buffer:
-            logger.info("No stations available within buffer range. Expanding buffer range.")
-            if buffer_range + 25 > truck_range:
-                logger.info("No further fuel stations found within the maximum distance truck can travel.")
-                logger.info(f"No. of Optimal Stations: {len(optimal_stations)}")
-                return optimal_stations
-            buffer_range += 25
+    if not nearby_stations_list:
+        logger.info("No fuel stations found near the route.")
+        return optimal_stations
+
+    node_miles = np.concatenate(([0.0], route_miles))
+    node_prices = np.concatenate(([average_price], [s["price_per_gallon"] for s in nearby_stations_list]))
+
+    # Cheapest known (cost, stops) to reach each node and the node it is reached from
+    costs = np.full(len(node_miles), np.inf)
+    costs[0] = 0.0
+    stops = np.zeros(len(node_miles), dtype=np.int64)
+    previous = np.zeros(len(node_miles), dtype=np.int64)
+    finish_cost, finish_stops, finish_previous = np.inf, 0, None
+
+    # Stations ahead on the route that are reachable from each node, keeping a 25-mile reserve
+    last_reachable = np.searchsorted(route_miles, node_miles + truck_range - 25, side="right")
+
+    for node in range(len(node_miles)):
+        cost = costs[node]
+        if cost == np.inf:
             continue
-
-        logger.info(f"Found {len(stations_in_buffer)} stations within buffer range.")
-
-        # Find the cheapest station
-        cheapest_station = min(stations_in_buffer, key=lambda s: s["price_per_gallon"])
-        logger.info(f"Selected Station: {cheapest_station}")
-
-        # Add the station to the optimal stations list
-        optimal_stations.append(cheapest_station)
-
-        # Update the current position and remaining distance
-        current_position = (cheapest_station["latitude"], cheapest_station["longitude"])
-        remaining_distance = geodesic(current_position, finish_location).miles
-
-        logger.info(f"Remaining Distance: {remaining_distance}")
+        position_miles, price = node_miles[node], node_prices[node]
 
         # Check if the destination is within range
+        remaining_distance = total_distance - position_miles
         if remaining_distance <= truck_range:
-            logger.info("Destination is within range. Stopping further calculations.")
-            break
-
-        # Remove visited stations from the list
-        cheapest_station_index = nearby_stations_list.index(cheapest_station)
-        nearby_stations_list = nearby_stations_list[cheapest_station_index + 1:]
-
-        logger.info(f"Length of remaining nearby_stations_list: {len(nearby_stations_list)}")
+            candidate = cost + remaining_distance / fuel_efficiency * price
+            if (candidate, stops[node]) < (finish_cost, finish_stops):
+                finish_cost, finish_stops, finish_previous = candidate, stops[node], node
+
+        # Relax every edge to the stations ahead at once, buying fuel for each leg at this node's price
+        last = last_reachable[node]
+        if last > node:
+            ahead = slice(node + 1, last + 1)
+            candidates = cost + (route_miles[node:last] - position_miles) / fuel_efficiency * price + stop_penalty
+            better = (candidates < costs[ahead]) | ((candidates == costs[ahead]) & (stops[node] + 1 < stops[ahead]))
+            improved = np.flatnonzero(better) + node + 1
+            costs[improved] = candidates[better]
+            stops[improved] = stops[node] + 1
+            previous[improved] = node
+
+    if finish_previous is not None:
+        node = finish_previous
+        logger.info(f"Minimum fuel cost estimate: {finish_cost - finish_stops * stop_penalty} over {finish_stops} stops")
+    else:
+        logger.info("Destination is not reachable through nearby stations. Routing to the furthest reachable station.")
+        node = np.flatnonzero(costs < np.inf)[-1]
+
+    while node != 0:
+        optimal_stations.append(nearby_stations_list[node - 1])
+        node = previous[node]
+    optimal_stations.reverse()
 
     logger.info(f"No. of Optimal Stations: {len(optimal_stations)}")
     return optimal_stations
@@ -169,31 +269,51 @@ def find_optimal_stations(start_location, nearby_stations_list, truck_range, buf
 class OptimalFuelRouteView(APIView):
     def post(self, request):
         try:
-            start_location = ast.literal_eval(request.data["start_location"])  # Example: "(34.052235, -118.243683)"
-            finish_location = ast.literal_eval(request.data["finish_location"])  # Example: "(36.778259, -119.417931)"
+            if not request.data.get("start_location") or not request.data.get("finish_location"):
+                return Response(
+                    {"error": "start_location and finish_location are required fields."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            try:
+                start_location = round_location(parse_location(request.data["start_location"]))  # Example: "(34.052235, -118.243683)"
+                finish_location = round_location(parse_location(request.data["finish_location"]))  # Example: "(36.778259, -119.417931)"
+            except (AttributeError, ValueError):
+                return Response(
+                    {"error": "start_location and finish_location must be formatted as \"(latitude, longitude)\"."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            if "buffer_range" in request.data:
+                logger.warning("buffer_range is deprecated and ignored; refuel stops are chosen by total cost.")
+
             truck_range = request.data.get("truck_range", 500)  # Optional truck range in miles
             fuel_efficiency = request.data.get("fuel_efficiency", 10)  # Optional fuel efficiency in mpg
-            buffer_range = request.data.get("buffer_range", 50)  # Optional buffer range in miles
             deviation_limit = request.data.get("deviation_limit", 2)  # Optional deviation limit in miles
 
-            if not start_location or not finish_location:
+            try:
+                stop_penalty = float(request.data.get("stop_penalty", STOP_PENALTY_USD))  # Optional planning cost per stop in USD
+                if not 0 <= stop_penalty < float("inf"):  # A negative penalty would reward extra stops
+                    raise ValueError(stop_penalty)
+            except (TypeError, ValueError):
                 return Response(
-                    {"error": "start_location and finish_location are required fields."},
+                    {"error": "stop_penalty must be a non-negative number."},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
             decoded_path, total_distance = find_polyline_points(start_location, finish_location)
             logger.info(f"Total road distance from start to end: {total_distance} miles.")
 
-            all_stations = FuelStation.objects.all()
+            station_index = StationIndex.instance()
 
-            if not all_stations.exists():  # Check if QuerySet is empty
+            if not len(station_index):  # Check if the station table is empty
                 return Response({'error': 'No fuel stations available'}, status=status.HTTP_400_BAD_REQUEST)
 
+            average_price = float(station_index.price_per_gallon.mean())
+
             # Check if the total distance is within the truck's range
             if total_distance <= truck_range:
                 # Calculate the fuel cost using the average price of all stations
-                average_price = sum(station.price_per_gallon for station in all_stations) / len(all_stations)
                 logger.info(f"Average price per gallon: {average_price}")
 
                 fuel_needed = total_distance / fuel_efficiency
@@ -209,12 +329,20 @@ class OptimalFuelRouteView(APIView):
                     "total_cost": total_cost
                 })
 
-            # Find stations near the route
-            station_coords = np.array([(station.latitude, station.longitude) for station in all_stations])
-            station_tree = cKDTree(station_coords)
-
-            nearby_stations_list = find_stations_near_route(start_location, decoded_path, all_stations, station_tree, deviation_limit)
-            optimal_stations = find_optimal_stations(start_location, nearby_stations_list, truck_range, buffer_range, finish_location)
+            # Find the cheapest refueling plan along the route, reusing a cached plan when available
+            cache_key = (
+                f"optimal-stations:{station_index.fingerprint}:{start_location[0]},{start_location[1]}:"
+                f"{finish_location[0]},{finish_location[1]}:{truck_range}:{fuel_efficiency}:{deviation_limit}:{stop_penalty}"
+            )
+            optimal_stations = cache.get(cache_key)
+            if optimal_stations is None:
+                nearby_stations_list, path_positions = find_stations_near_route(decoded_path, station_index, deviation_limit)
+                route_miles = cumulative_route_miles(decoded_path, total_distance)[path_positions]
+                optimal_stations = find_optimal_stations(
+                    nearby_stations_list, route_miles, total_distance, truck_range, fuel_efficiency, average_price,
+                    stop_penalty,
+                )
+                cache.set(cache_key, optimal_stations, settings.GOOGLE_MAPS_CACHE_TIMEOUT)
 
             # Prepare locations for Google Distance Matrix API
             locations = [
@@ -235,7 +363,7 @@ class OptimalFuelRouteView(APIView):
             logger.info("Route Map URL: " + route_map_url)
 
             distances = find_actual_distances(locations)
-            total_fuel_cost = calculate_fuel_cost(distances, all_stations, optimal_stations, fuel_efficiency)
+            total_fuel_cost = calculate_fuel_cost(distances, average_price, optimal_stations, fuel_efficiency)
 
             # Return final response
             response_data = {